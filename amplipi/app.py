@@ -23,32 +23,38 @@ The FastAPI/Starlette web framework is used to simplify the web plumbing.
 """
 
 import argparse
+import atexit
 
 DEBUG_API = False
 
 import os
 
 # type handling, fastapi leverages type checking for performance and easy docs
-from typing import List, Dict, Set, Any, Optional, Callable, Union, TYPE_CHECKING, get_type_hints
+from typing import List, Dict, Set, Tuple, Any, Optional, Callable, Union, TYPE_CHECKING, get_type_hints
 from types import SimpleNamespace
 
 import urllib.request # For custom album art size
 from queue import Queue
-from functools import lru_cache
+from functools import lru_cache, wraps
+from concurrent.futures import ThreadPoolExecutor
 import asyncio
 import json
+import orjson
 import yaml
 from time import sleep
 
 from PIL import Image # For custom album art size
 
 # web framework
-from fastapi import FastAPI, Request, Response, HTTPException, Depends, Path
+from fastapi import FastAPI, Request, Response, HTTPException, Depends, Path, WebSocket
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.openapi.utils import get_openapi # docs
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import ORJSONResponse
 from fastapi.routing import APIRoute, APIRouter
 from fastapi.templating import Jinja2Templates
 from starlette.responses import FileResponse
+from starlette.websockets import WebSocketState
 from sse_starlette.sse import EventSourceResponse
 
 # mdns service advertisement
@@ -67,24 +73,86 @@ TEMPLATE_DIR = os.path.abspath('web/templates')
 STATIC_DIR = os.path.abspath('web/static')
 GENERATED_DIR = os.path.abspath('web/generated')
 
-app = FastAPI(openapi_url=None, redoc_url=None,) # we host docs using rapidoc instead via a custom endpoint, so the default endpoints need to be disabled
+# we host docs using rapidoc instead via a custom endpoint, so the default endpoints need to be disabled
+# responses are serialized with orjson, it is much faster than the standard json library for our large status responses
+app = FastAPI(openapi_url=None, redoc_url=None, default_response_class=ORJSONResponse)
 templates = Jinja2Templates(TEMPLATE_DIR)
 
+class JSONGZipMiddleware(GZipMiddleware):
+  """ Compress the api's json responses
+
+  The full status is repetitive json that compresses well. Images are already compressed,
+  so compressing them (and the other static files) only costs cpu time on the Pi.
+  """
+  # pylint: disable=too-few-public-methods
+  async def __call__(self, scope, receive, send):
+    path = scope.get('path', '')
+    if path.startswith(('/api', '/openapi')) and '/image/' not in path:
+      await super().__call__(scope, receive, send)
+    else:
+      await self.app(scope, receive, send)
+
+# small responses aren't worth compressing
+app.add_middleware(JSONGZipMiddleware, minimum_size=1000)
+
 app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 app.mount("/generated", StaticFiles(directory=GENERATED_DIR), name="generated") # TODO: make this register as a dynamic folder???
 
+@app.on_event('startup')
+async def check_event_loop():
+  """ Report which event loop is serving the app
+
+  uvicorn uses uvloop (and httptools) automatically when they are installed, so make any fallback to asyncio visible """
+  print(f'AmpliPi - using event loop from {type(asyncio.get_running_loop()).__module__}')
+
+
+def dump_model(obj: Any) -> Any:
+  """ Convert pydantic models, that orjson doesn't natively support, to dictionaries """
+  if isinstance(obj, models.BaseModel):
+    return obj.dict(exclude_none=True)
+  raise TypeError
+
+class TrustedResponse(ORJSONResponse):
+  """ Directly serialize trusted internal state to json
+
+  FastAPI validates a response against its response_model before encoding it,
+  this is a full walk of the state that is wasted on state that was already validated when it was modified.
+  """
+  def render(self, content: Any) -> bytes:
+    return orjson.dumps(content, default=dump_model)
+
+def trusted_response(endpoint: Callable[..., Any]) -> Callable[..., Any]:
+  """ Wrap an @endpoint so its result is sent as a TrustedResponse """
+  if asyncio.iscoroutinefunction(endpoint):
+    @wraps(endpoint)
+    async def async_wrapper(*endpoint_args, **endpoint_kwargs):
+      resp = await endpoint(*endpoint_args, **endpoint_kwargs)
+      return resp if isinstance(resp, Response) else TrustedResponse(resp)
+    return async_wrapper
+  @wraps(endpoint)
+  def wrapper(*endpoint_args, **endpoint_kwargs):
+    resp = endpoint(*endpoint_args, **endpoint_kwargs)
+    return resp if isinstance(resp, Response) else TrustedResponse(resp)
+  return wrapper
 
 class SimplifyingRouter(APIRouter):
   """
   Overrides the route decorator logic to:
   - to use the annotated return type as the `response_model` if unspecified.
   - always exclude unset fields (this makes so much more sense!)
+  - skip response validation on GET requests, they only return the trusted internal state
   """
   if not TYPE_CHECKING:  # pragma: no branch
     def add_api_route(self, path: str, endpoint: Callable[..., Any], **kwargs: Any) -> None:
       if kwargs.get("response_model") is None:
-        kwargs["response_model"] = get_type_hints(endpoint).get("return")
+        return_type = endpoint.__annotations__.get("return")
+        if isinstance(return_type, str): # only forward references need to be resolved
+          return_type = get_type_hints(endpoint).get("return")
+        kwargs["response_model"] = return_type
       kwargs["response_model_exclude_none"] = True
+      if 'GET' in (kwargs.get('methods') or []):
+        # the response_model is still used to document the response
+        endpoint = trusted_response(endpoint)
       return super().add_api_route(path, endpoint, **kwargs)
 
 # Helper functions
@@ -98,28 +166,56 @@ def unused_zones(ctrl: Api, src: int) -> Dict[int, str]:
   zones = ctrl.status.zones
   return {z.id : z.name for z in zones if z.source_id != src and z.id is not None}
 
-def ungrouped_zones(ctrl: Api, src: int) -> List[models.Zone]:
-  """ Get zones that are connected to src, but don't belong to a full group """
-  zones = ctrl.status.zones
-  groups = ctrl.status.groups
-  # get all of the zones that belong to this sources groups
-  grouped_zones: Set[int] = set()
-  for group in groups:
-    if group.source_id == src:
-      grouped_zones = grouped_zones.union(group.zones)
-  # get all of the zones connected to this soource
-  source_zones = {z.id for z in zones if z.source_id == src}
-  # return all of the zones connected to this source that aren't in a group
-  ungrouped_zones_ = source_zones.difference(grouped_zones)
-  return [zones[z] for z in ungrouped_zones_ if z is not None and not zones[z].disabled]
-
-# add a default controller (this is overriden below in create_app)
-@lru_cache(1) # Api controller should only be instantiated once (we clear the cache with get_ctr.cache_clear() after settings object is configured)
+def grouped_zones(ctrl: Api) -> Dict[int, Set[int]]:
+  """ Get the zones that belong to each source's groups """
+  grouped: Dict[int, Set[int]] = {}
+  for group in ctrl.status.groups:
+    if group.source_id is not None:
+      grouped.setdefault(group.source_id, set()).update(group.zones)
+  return grouped
+
+def ungrouped_zones(ctrl: Api, src: int, grouped: Optional[Set[int]] = None) -> List[models.Zone]:
+  """ Get zones that are connected to src, but don't belong to a full group
+
+  @grouped, the zones belonging to src's groups, is looked up if not given """
+  if grouped is None:
+    grouped = grouped_zones(ctrl).get(src, set())
+  return [z for z in ctrl.status.zones if z.source_id == src and not z.disabled and z.id is not None and z.id not in grouped]
+
+SONG_FIELDS = ('artist', 'album', 'track', 'img_url') # song info displayed by the web app
+NO_SONG_INFO = {field: '' for field in SONG_FIELDS} # shared between sources without any info, do not modify
+
+def song_info(src: models.Source) -> Dict[str, str]:
+  """ Get the song info displayed for src, missing fields are left empty """
+  info = src.info
+  if info is None:
+    return NO_SONG_INFO
+  return {field: getattr(info, field) or '' for field in SONG_FIELDS}
+
+# the controller, this is configured in create_app or created with the default settings on first use
+_ctrl: Optional[Api] = None
+
 def get_ctrl() -> Api:
   """ Get the controller
   Makes a single instance of the controller to avoid duplicates (Singleton pattern)
   """
-  return Api(models.AppSettings())
+  global _ctrl # pylint: disable=global-statement
+  if _ctrl is None:
+    _ctrl = Api(models.AppSettings())
+  return _ctrl
+
+@atexit.register
+def release_ctrl() -> None:
+  """ Release the controller before the interpreter starts tearing down modules, so it can still save any pending changes """
+  global _ctrl # pylint: disable=global-statement
+  _ctrl = None
+
+async def ctrl_dependency() -> Api:
+  """ Get the controller for a request
+
+  FastAPI runs sync dependencies in its threadpool, this is async so it is resolved directly on the event loop
+  """
+  return get_ctrl()
 
 class params(SimpleNamespace):
   """ Describe standard path ID's for each api type """
@@ -137,15 +233,66 @@ class params(SimpleNamespace):
 api = SimplifyingRouter()
 
 @api.get('/api', tags=['status'])
-def get_status(ctrl: Api = Depends(get_ctrl)) -> models.Status:
+async def get_status(ctrl: Api = Depends(ctrl_dependency)) -> models.Status:
   """ Get the system status and configuration """
-  return ctrl.get_state()
+  return ctrl.get_state_cached()
 
 subscribers: Dict[int, 'Queue[models.Status]'] = {}
+# websocket clients waiting for a new state, each is woken on its own event loop by the state pusher, see push_state
+state_listeners: Set[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = set()
+# the task shared by all of the websocket clients, and the event used to wake it on a change (made from any thread)
+state_pusher: Optional[Tuple[asyncio.AbstractEventLoop, asyncio.Event, 'asyncio.Future[None]']] = None
+latest_state = '' # the serialized state most recently pushed to websocket clients
+STATE_REFRESH_INTERVAL = 2.0 # stream info changes without notification, so it is refreshed as often as the web app used to poll
+
+def wake(loop: asyncio.AbstractEventLoop, event: asyncio.Event) -> None:
+  """ Set @event from any thread """
+  try:
+    loop.call_soon_threadsafe(event.set)
+  except RuntimeError:
+    pass # the loop was closed, anything waiting on it is gone
+
 def notify_on_change(status: models.Status) -> None:
   """ Notify subscribers that something has changed """
   for msg_que in subscribers.values():
     msg_que.put(status)
+  pusher = state_pusher
+  if pusher:
+    wake(*pusher[:2])
+
+async def push_state_changes(changed: asyncio.Event) -> None:
+  """ Refresh and serialize the state once for all of the websocket clients, waking them when it changes
+
+  The state is checked right after a change and every STATE_REFRESH_INTERVAL seconds in between, until no clients are left.
+  """
+  global latest_state # pylint: disable=global-statement
+  while state_listeners:
+    try:
+      state = orjson.dumps(get_ctrl().get_state_cached(STATE_REFRESH_INTERVAL), default=dump_model).decode()
+    except Exception as exc:
+      # keep running, the clients have no other way to get updates while they are connected
+      print(f'Error refreshing the state for websocket clients: {exc}')
+    else:
+      if state != latest_state:
+        latest_state = state
+        for listener in list(state_listeners):
+          wake(*listener)
+    try:
+      await asyncio.wait_for(changed.wait(), STATE_REFRESH_INTERVAL)
+    except asyncio.TimeoutError:
+      pass
+    changed.clear()
+
+def start_state_pusher() -> None:
+  """ Start the shared state pusher on the current event loop, unless it is already running """
+  global state_pusher, latest_state # pylint: disable=global-statement
+  if state_pusher:
+    loop, _, task = state_pusher
+    if not task.done() and loop.is_running():
+      return
+  latest_state = '' # anything left over is from before the last client disconnected
+  changed = asyncio.Event()
+  state_pusher = (asyncio.get_running_loop(), changed, asyncio.ensure_future(push_state_changes(changed)))
 
 # @api.get('/api/subscribe') # TODO: uncomment this to add SSE Support and properly document it
 async def subscribe(req: Request):
@@ -170,34 +317,83 @@ async def subscribe(req: Request):
       raise exc
   return EventSourceResponse(stream())
 
+@app.websocket('/ws/state')
+async def push_state(websocket: WebSocket):
+  """ Push the system state to a websocket client
+
+  The full state is sent on connection and again whenever it changes. This replaces polling `/api` with a single connection
+  that only transfers the state when there is something new. The state is refreshed and serialized by a single task shared
+  by all of the clients, see push_state_changes.
+  """
+  await websocket.accept()
+  changed = asyncio.Event()
+  listener = (asyncio.get_running_loop(), changed)
+  state_listeners.add(listener)
+  start_state_pusher()
+
+  async def wait_for_disconnect():
+    while (await websocket.receive())['type'] != 'websocket.disconnect':
+      pass # clients have nothing to say
+    changed.set()
+
+  receiver = asyncio.ensure_future(wait_for_disconnect())
+  last_sent = ''
+  try:
+    while websocket.client_state == WebSocketState.CONNECTED:
+      state = latest_state
+      if state and state != last_sent:
+        await websocket.send_text(state)
+        last_sent = state
+      await changed.wait()
+      changed.clear()
+  finally:
+    state_listeners.discard(listener)
+    receiver.cancel()
+
 def code_response(ctrl: Api, resp: Union[ApiResponse, models.BaseModel]):
-  """ Convert amplipi.ctrl.Api responses to json/http responses """
+  """ Convert amplipi.ctrl.Api responses to json/http responses
+
+  Successful responses are the controller's own state, so they are serialized
+  directly instead of being validated against the route's response_model.
+  """
   if isinstance(resp, ApiResponse):
     if resp.code == ApiCode.OK:
       # general commands return None to indicate success
-      return ctrl.get_state()
+      return TrustedResponse(ctrl.get_state())
     # TODO: refine error codes based on error message
     raise HTTPException(404, resp.msg)
-  return resp
+  return TrustedResponse(resp)
+
+# controller changes are made one at a time on a single thread, they share the system state and the preamp's I2C bus
+ctrl_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ctrl')
+
+async def ctrl_response(ctrl: Api, change: Callable[..., Union[ApiResponse, models.BaseModel]], *change_args: Any, **change_kwargs: Any):
+  """ Make a change using the controller and convert its result, see code_response
+
+  The blocking change is run on ctrl_executor's thread so the event loop stays free to serve other requests
+  """
+  def make_change():
+    return code_response(ctrl, change(*change_args, **change_kwargs))
+  return await asyncio.get_running_loop().run_in_executor(ctrl_executor, make_change)
 
 # sources
 
 @api.get('/api/sources', tags=['source'])
-def get_sources(ctrl: Api = Depends(get_ctrl)) -> Dict[str, List[models.Source]]:
+async def get_sources(ctrl: Api = Depends(ctrl_dependency)) -> Dict[str, List[models.Source]]:
   """ Get all sources """
-  return {'sources' : ctrl.get_state().sources}
+  return {'sources' : ctrl.get_state_cached().sources}
 
 @api.get('/api/sources/{sid}', tags=['source'])
-def get_source(ctrl: Api = Depends(get_ctrl), sid: int = params.SourceID) -> models.Source:
+async def get_source(ctrl: Api = Depends(ctrl_dependency), sid: int = params.SourceID) -> models.Source:
   """ Get Source with id=**sid** """
   # TODO: add get_X capabilities to underlying API?
-  sources = ctrl.get_state().sources
+  sources = ctrl.get_state_cached().sources
   return sources[sid]
 
 @api.patch('/api/sources/{sid}', tags=['source'])
-def set_source(update: models.SourceUpdate, ctrl: Api = Depends(get_ctrl), sid: int = params.SourceID) -> models.Status:
+async def set_source(update: models.SourceUpdate, ctrl: Api = Depends(ctrl_dependency), sid: int = params.SourceID) -> models.Status:
   """ Update a source's configuration (source=**sid**) """
-  return code_response(ctrl, ctrl.set_source(sid, update))
+  return await ctrl_response(ctrl, ctrl.set_source, sid, update)
 
 @api.get('/api/sources/{sid}/image/{height}', tags=['source'],
   # Manually specify a possible response
@@ -209,7 +405,7 @@ def set_source(update: models.SourceUpdate, ctrl: Api = Depends(get_ctrl), sid:
       }
   },
 )
-async def get_image(ctrl: Api = Depends(get_ctrl), sid: int = params.SourceID, height: int = params.ImageHeight):
+async def get_image(ctrl: Api = Depends(ctrl_dependency), sid: int = params.SourceID, height: int = params.ImageHeight):
   """ Get a square jpeg image representing the current media playing on source @sid
 
   This was added to support low power touch panels """
@@ -249,96 +445,98 @@ async def get_image(ctrl: Api = Depends(get_ctrl), sid: int = params.SourceID, h
 # zones
 
 @api.get('/api/zones', tags=['zone'])
-def get_zones(ctrl: Api = Depends(get_ctrl)) -> Dict[str, List[models.Zone]]:
+async def get_zones(ctrl: Api = Depends(ctrl_dependency)) -> Dict[str, List[models.Zone]]:
   """ Get all zones """
-  return {'zones': ctrl.get_state().zones}
+  return {'zones': ctrl.get_state_cached().zones}
 
 @api.get('/api/zones/{zid}', tags=['zone'])
-def get_zone(ctrl: Api = Depends(get_ctrl), zid: int = params.ZoneID) -> models.Zone:
+async def get_zone(ctrl: Api = Depends(ctrl_dependency), zid: int = params.ZoneID) -> models.Zone:
   """ Get Zone with id=**zid** """
-  zones = ctrl.get_state().zones
+  zones = ctrl.get_state_cached().zones
   if 0 <= zid < len(zones):
     return zones[zid]
   raise HTTPException(404, f'zone {zid} not found')
 
 @api.patch('/api/zones/{zid}', tags=['zone'])
-def set_zone(zone: models.ZoneUpdate, ctrl: Api = Depends(get_ctrl), zid: int = params.ZoneID) -> models.Status:
+async def set_zone(zone: models.ZoneUpdate, ctrl: Api = Depends(ctrl_dependency), zid: int = params.ZoneID) -> models.Status:
   """ Update a zone's configuration (zone=**zid**) """
-  return code_response(ctrl, ctrl.set_zone(zid, zone))
+  return await ctrl_response(ctrl, ctrl.set_zone, zid, zone)
 
-# TODO: add set_zones(ctrl: Api = Depends(get_ctrl), zones:List[int]=[], groups:List[int]=[], update:ZoneUpdate)
+# TODO: add set_zones(ctrl: Api = Depends(ctrl_dependency), zones:List[int]=[], groups:List[int]=[], update:ZoneUpdate)
 
 # groups
 
 @api.post('/api/group', tags=['group'])
-def create_group(group: models.Group, ctrl: Api = Depends(get_ctrl)) -> models.Group:
+async def create_group(group: models.Group, ctrl: Api = Depends(ctrl_dependency)) -> models.Group:
   """ Create a new grouping of zones """
   # TODO: add named example group
-  return code_response(ctrl, ctrl.create_group(group))
+  return await ctrl_response(ctrl, ctrl.create_group, group)
 
 @api.get('/api/groups', tags=['group'])
-def get_groups(ctrl: Api = Depends(get_ctrl)) -> Dict[str, List[models.Group]]:
+async def get_groups(ctrl: Api = Depends(ctrl_dependency)) -> Dict[str, List[models.Group]]:
   """ Get all groups """
-  return {'groups' : ctrl.get_state().groups}
+  return {'groups' : ctrl.get_state_cached().groups}
 
 @api.get('/api/groups/{gid}', tags=['group'])
-def get_group(ctrl: Api = Depends(get_ctrl), gid: int = params.GroupID) -> models.Group:
+async def get_group(ctrl: Api = Depends(ctrl_dependency), gid: int = params.GroupID) -> models.Group:
   """ Get Group with id=**gid** """
-  _, grp = utils.find(ctrl.get_state().groups, gid)
+  state = ctrl.get_state_cached()
+  _, grp = ctrl.find_item(state.groups, ctrl.groups_by_id, gid)
   if grp is not None:
     return grp
   raise HTTPException(404, f'group {gid} not found')
 
 @api.patch('/api/groups/{gid}', tags=['group'])
-def set_group(group: models.GroupUpdate, ctrl: Api = Depends(get_ctrl), gid: int = params.GroupID) -> models.Status:
+async def set_group(group: models.GroupUpdate, ctrl: Api = Depends(ctrl_dependency), gid: int = params.GroupID) -> models.Status:
   """ Update a groups's configuration (group=**gid**) """
-  return code_response(ctrl, ctrl.set_group(gid, group))
+  return await ctrl_response(ctrl, ctrl.set_group, gid, group)
 
 @api.delete('/api/groups/{gid}', tags=['group'])
-def delete_group(ctrl: Api = Depends(get_ctrl), gid: int = params.GroupID) -> models.Status:
+async def delete_group(ctrl: Api = Depends(ctrl_dependency), gid: int = params.GroupID) -> models.Status:
   """ Delete a group (group=**gid**) """
-  return code_response(ctrl, ctrl.delete_group(gid))
+  return await ctrl_response(ctrl, ctrl.delete_group, gid)
 
 # streams
 
 @api.post('/api/stream', tags=['stream'])
-def create_stream(stream: models.Stream, ctrl: Api = Depends(get_ctrl)) -> models.Stream:
+async def create_stream(stream: models.Stream, ctrl: Api = Depends(ctrl_dependency)) -> models.Stream:
   """ Create a new audio stream
   - For Pandora the station is the number at the end of the Pandora URL for a 'station', e.g. 4610303469018478727 from https://www.pandora.com/station/play/4610303469018478727. 'user' and 'password' are the account username and password
   """
-  return code_response(ctrl, ctrl.create_stream(stream))
+  return await ctrl_response(ctrl, ctrl.create_stream, stream)
 
 @api.get('/api/streams', tags=['stream'])
-def get_streams(ctrl: Api = Depends(get_ctrl)) -> Dict[str, List[models.Stream]]:
+async def get_streams(ctrl: Api = Depends(ctrl_dependency)) -> Dict[str, List[models.Stream]]:
   """ Get all streams """
-  return {'streams' : ctrl.get_state().streams}
+  return {'streams' : ctrl.get_state_cached().streams}
 
 @api.get('/api/streams/{sid}', tags=['stream'])
-def get_stream(ctrl: Api = Depends(get_ctrl), sid: int = params.StreamID) -> models.Stream:
+async def get_stream(ctrl: Api = Depends(ctrl_dependency), sid: int = params.StreamID) -> models.Stream:
   """ Get Stream with id=**sid** """
-  _, stream = utils.find(ctrl.get_state().streams, sid)
+  state = ctrl.get_state_cached()
+  _, stream = ctrl.find_item(state.streams, ctrl.streams_by_id, sid)
   if stream is not None:
     return stream
   raise HTTPException(404, f'stream {sid} not found')
 
 @api.patch('/api/streams/{sid}', tags=['stream'])
-def set_stream(ctrl: Api = Depends(get_ctrl), sid: int = params.StreamID, update: models.StreamUpdate = None) -> models.Status:
+async def set_stream(ctrl: Api = Depends(ctrl_dependency), sid: int = params.StreamID, update: models.StreamUpdate = None) -> models.Status:
   """ Update a stream's configuration (stream=**sid**) """
-  return code_response(ctrl, ctrl.set_stream(sid, update))
+  return await ctrl_response(ctrl, ctrl.set_stream, sid, update)
 
 @api.delete('/api/streams/{sid}', tags=['stream'])
-def delete_stream(ctrl: Api = Depends(get_ctrl), sid: int = params.StreamID) -> models.Status:
+async def delete_stream(ctrl: Api = Depends(ctrl_dependency), sid: int = params.StreamID) -> models.Status:
   """ Delete a stream """
-  return code_response(ctrl, ctrl.delete_stream(sid))
+  return await ctrl_response(ctrl, ctrl.delete_stream, sid)
 
 @api.post('/api/streams/{sid}/station={station}', tags=['stream'])
-def change_station(ctrl: Api = Depends(get_ctrl), sid: int = params.StreamID, station: int = params.StationID) -> models.Status:
+async def change_station(ctrl: Api = Depends(ctrl_dependency), sid: int = params.StreamID, station: int = params.StationID) -> models.Status:
   """ Change station on a pandora stream (stream=**sid**) """
   # This is a specific version of exec command, it needs to be placed before the genertic version so the path is resolved properly
-  return code_response(ctrl, ctrl.exec_stream_command(sid, cmd=f'station={station}'))
+  return await ctrl_response(ctrl, ctrl.exec_stream_command, sid, cmd=f'station={station}')
 
 @api.post('/api/streams/{sid}/{cmd}', tags=['stream'])
-def exec_command(ctrl: Api = Depends(get_ctrl), sid: int = params.StreamID, cmd: models.StreamCommand = None) -> models.Status:
+async def exec_command(ctrl: Api = Depends(ctrl_dependency), sid: int = params.StreamID, cmd: models.StreamCommand = None) -> models.Status:
   """ Executes a comamnd on a stream (stream=**sid**).
 
     Command options:
@@ -351,49 +549,57 @@ def exec_command(ctrl: Api = Depends(get_ctrl), sid: int = params.StreamID, cmd:
     * Shelve Current Song (pandora only): **shelve**
 
   Currently only available with Pandora streams"""
-  return code_response(ctrl, ctrl.exec_stream_command(sid, cmd=cmd))
+  return await ctrl_response(ctrl, ctrl.exec_stream_command, sid, cmd=cmd)
 
 # presets
 
 @api.post('/api/preset', tags=['preset'])
-def create_preset(preset: models.Preset, ctrl: Api = Depends(get_ctrl)) -> models.Preset:
+async def create_preset(preset: models.Preset, ctrl: Api = Depends(ctrl_dependency)) -> models.Preset:
   """ Create a new preset configuration """
-  return code_response(ctrl, ctrl.create_preset(preset))
+  return await ctrl_response(ctrl, ctrl.create_preset, preset)
 
 @api.get('/api/presets', tags=['preset'])
-def get_presets(ctrl: Api = Depends(get_ctrl)) -> Dict[str, List[models.Preset]]:
+async def get_presets(ctrl: Api = Depends(ctrl_dependency)) -> Dict[str, List[models.Preset]]:
   """ Get all presets """
-  return {'presets' : ctrl.get_state().presets}
+  return {'presets' : ctrl.get_state_cached().presets}
 
 @api.get('/api/presets/{pid}', tags=['preset'])
-def get_preset(ctrl: Api = Depends(get_ctrl), pid: int = params.PresetID) -> models.Preset:
+async def get_preset(ctrl: Api = Depends(ctrl_dependency), pid: int = params.PresetID) -> models.Preset:
   """ Get Preset with id=**pid** """
-  _, preset = utils.find(ctrl.get_state().presets, pid)
+  state = ctrl.get_state_cached()
+  _, preset = ctrl.find_item(state.presets, ctrl.presets_by_id, pid)
   if preset is not None:
     return preset
   raise HTTPException(404, f'preset {pid} not found')
 
 @api.patch('/api/presets/{pid}', tags=['preset'])
-def set_preset(ctrl: Api = Depends(get_ctrl), pid: int = params.PresetID, update: models.PresetUpdate = None) -> models.Status:
+async def set_preset(ctrl: Api = Depends(ctrl_dependency), pid: int = params.PresetID, update: models.PresetUpdate = None) -> models.Status:
   """ Update a preset's configuration (preset=**pid**) """
-  return code_response(ctrl, ctrl.set_preset(pid, update))
+  return await ctrl_response(ctrl, ctrl.set_preset, pid, update)
 
 @api.delete('/api/presets/{pid}', tags=['preset'])
-def delete_preset(ctrl: Api = Depends(get_ctrl), pid: int = params.PresetID) -> models.Status:
+async def delete_preset(ctrl: Api = Depends(ctrl_dependency), pid: int = params.PresetID) -> models.Status:
   """ Delete a preset """
-  return code_response(ctrl, ctrl.delete_preset(pid))
+  return await ctrl_response(ctrl, ctrl.delete_preset, pid)
 
 @api.post('/api/presets/{pid}/load', tags=['preset'])
-def load_preset(ctrl: Api = Depends(get_ctrl), pid: int = params.PresetID) -> models.Status:
+async def load_preset(ctrl: Api = Depends(ctrl_dependency), pid: int = params.PresetID) -> models.Status:
   """ Load a preset configuration """
-  return code_response(ctrl, ctrl.load_preset(pid))
+  return await ctrl_response(ctrl, ctrl.load_preset, pid)
 
 # PA
 
 @api.post('/api/announce', tags=['announce'])
-def announce(announcement: models.Announcement, ctrl: Api = Depends(get_ctrl)) -> models.Status:
+async def announce(announcement: models.Announcement, ctrl: Api = Depends(ctrl_dependency)) -> models.Status:
   """ Make an announcement """
-  return code_response(ctrl, ctrl.announce(announcement))
+  # like any other change the announcement is started and finished on ctrl_executor,
+  # other changes can be made while it plays
+  sid = await asyncio.get_running_loop().run_in_executor(ctrl_executor, ctrl.start_announcement, announcement)
+  if isinstance(sid, ApiResponse):
+    return code_response(ctrl, sid)
+  while not ctrl.announcement_done(sid):
+    await asyncio.sleep(0.1)
+  return await ctrl_response(ctrl, ctrl.finish_announcement, sid)
 
 # include all routes above
 
@@ -485,9 +691,20 @@ def add_example_params(openapi_schema, route: APIRoute) -> None:
           if param['name'] == xid_param:
             param['examples'] = live_examples
 
+def add_live_examples(openapi_schema) -> None:
+  """ Add example parameters for every route, these come from the live configuration so they can change between requests """
+  for route in app.routes:
+    if isinstance(route, APIRoute):
+      add_example_params(openapi_schema, route)
+
 def generate_openapi_spec(add_test_docs=True):
-  """ Generate the openapi spec using documentation embedded in the models and routes """
-  if app.openapi_schema:
+  """ Generate the openapi spec using documentation embedded in the models and routes
+
+  The served version, with test docs, is only generated once and cached in app.openapi_schema.
+  Its parameter examples are regenerated on every call since they come from the live configuration.
+  """
+  if add_test_docs and app.openapi_schema:
+    add_live_examples(app.openapi_schema)
     return app.openapi_schema
   openapi_schema = get_openapi(
     title='AmpliPi',
@@ -545,10 +762,8 @@ def generate_openapi_spec(add_test_docs=True):
   if not add_test_docs:
     return openapi_schema
 
-  for route in app.routes:
-    if isinstance(route, APIRoute):
-      add_example_params(openapi_schema, route)
-
+  add_live_examples(openapi_schema)
+  app.openapi_schema = openapi_schema
   return openapi_schema
 
 YAML_DESCRIPTION = """| # The links in the description below are tested to work with redoc and may not be portable
@@ -627,7 +842,8 @@ def create_yaml_doc(add_test_docs=True) -> str:
   """
   openapi = app.openapi()
   # use a placeholder for the description, multiline strings weren't using block formatting
-  openapi['info']['description'] = '$REPLACE_ME$'
+  # the schema is cached, so modify a copy
+  openapi = {**openapi, 'info': {**openapi['info'], 'description': '$REPLACE_ME$'}}
   yaml_s = yaml.safe_dump(openapi, sort_keys=False, allow_unicode=True)
   # fix the long description
   return yaml_s.replace('$REPLACE_ME$', YAML_DESCRIPTION)
@@ -646,7 +862,8 @@ def read_openapi_json():
   """ Read the openapi json file
 
   This is slightly easier to process by our test framework """
-  return app.openapi()
+  # the schema is plain json data, skip FastAPI's generic encoding
+  return ORJSONResponse(app.openapi())
 
 app.openapi = generate_openapi_spec # type: ignore
 
@@ -662,9 +879,11 @@ def doc():
 
 @app.get('/', include_in_schema=False)
 @app.get('/{src}', include_in_schema=False)
-def view(request: Request, ctrl: Api = Depends(get_ctrl), src: int = 0):
+def view(request: Request, ctrl: Api = Depends(ctrl_dependency), src: int = 0):
   """ Webapp main view """
-  state = ctrl.get_state()
+  state = ctrl.get_state() # refresh the state once, the helpers below use this snapshot
+  src_ids = [src.id for src in state.sources if src.id is not None]
+  grouped = grouped_zones(ctrl)
   context = {
     # needed for template to make response
     'request': request,
@@ -675,10 +894,10 @@ def view(request: Request, ctrl: Api = Depends(get_ctrl), src: int = 0):
     'groups': state.groups,
     'presets': state.presets,
     'inputs': [ctrl.get_inputs(src) for src in state.sources],
-    'unused_groups': [unused_groups(ctrl, src.id) for src in state.sources if src.id is not None],
-    'unused_zones': [unused_zones(ctrl, src.id) for src in state.sources if src.id is not None],
-    'ungrouped_zones': [ungrouped_zones(ctrl, src.id) for src in state.sources if src.id is not None],
-    'song_info': [src.info for src in state.sources if src.info is not None], # src.info should never be None
+    'unused_groups': [unused_groups(ctrl, sid) for sid in src_ids],
+    'unused_zones': [unused_zones(ctrl, sid) for sid in src_ids],
+    'ungrouped_zones': [ungrouped_zones(ctrl, sid, grouped.get(sid, set())) for sid in src_ids],
+    'song_info': [song_info(src) for src in state.sources],
     'version': state.info.version if state.info else 'unknown',
   }
   return templates.TemplateResponse('index.html.j2', context, media_type='text/html')
@@ -694,7 +913,11 @@ def create_app(mock_ctrl=None, mock_streams=None, config_file=None, delay_saves=
     settings.config_file = config_file
   if delay_saves is not None:
     settings.delay_saves = delay_saves
-  get_ctrl().reinit(settings, change_notifier=notify_on_change)
+  global _ctrl # pylint: disable=global-statement
+  if _ctrl is None:
+    _ctrl = Api(settings, change_notifier=notify_on_change)
+  else:
+    _ctrl.reinit(settings, change_notifier=notify_on_change)
   return app
 
 def get_ip_addr(iface: str = 'eth0') -> Optional[str]:
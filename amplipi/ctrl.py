@@ -20,7 +20,7 @@ This module provides complete control of the AmpliPi Audio System's sources,
 zones, groups and streams.
 """
 
-from typing import List, Dict, Set, Union, Optional, Callable
+from typing import List, Dict, Set, Tuple, Union, Optional, Callable
 
 from enum import Enum
 
@@ -86,12 +86,18 @@ class Api:
   _save_timer: Optional[threading.Timer] = None
   _delay_saves: bool
   _change_notifier: Optional[Callable[[models.Status], None]] = None
+  _state_refreshed: float = 0.0 # time of the last full state refresh
+  _state_changed: bool = True # has the state been modified since the last refresh?
   _rt: Union[rt.Rpi, rt.Mock]
   config_file: str
   backup_config_file: str
   config_file_valid: bool
   status: models.Status
   streams: Dict[int, amplipi.streams.AnyStream]
+  # id->index maps of the status lists, rebuilt on every state refresh, see find_item
+  groups_by_id: Dict[int, int]
+  streams_by_id: Dict[int, int]
+  presets_by_id: Dict[int, int]
 
   _LAST_PRESET_ID = 9999
   DEFAULT_CONFIG = { # This is the system state response that will come back from the amplipi box
@@ -166,6 +172,8 @@ class Api:
 
     Intitializes the system to to base configuration """
     self._change_notifier = change_notifier
+    self._state_changed = True
+    self.groups_by_id, self.streams_by_id, self.presets_by_id = {}, {}, {}
     self._mock_hw = settings.mock_ctrl
     self._mock_streams = settings.mock_streams
     self._save_timer = None
@@ -250,6 +258,7 @@ class Api:
 
     This attempts to avoid excessive saving and the resulting delays by only saving a small delay after the last change
     """
+    self._state_changed = True
     if self._change_notifier:
       self._change_notifier(self.get_state())
     if self._delay_saves:
@@ -274,6 +283,9 @@ class Api:
   def get_inputs(self, src: models.Source) -> Dict[Union[str, None], str]:
     """Gets a dictionary of the possible inputs for a source
 
+      This uses the streams gathered by the last call to get_state(),
+      so a series of sources can be handled without refreshing the state for each of them
+
       Returns:
         A dictionary of the input types and a corresponding user friendly name/string for each
       Example:
@@ -283,7 +295,7 @@ class Api:
         { None, '', 'local', 'Local', 'stream=9449' }
     """
     inputs = {None: '', 'local' : f'{src.name} - rca'}
-    for stream in self.get_state().streams:
+    for stream in self.status.streams:
       inputs['stream={}'.format(stream.id)] = f'{stream.name} - {stream.type}'
     return inputs
 
@@ -297,7 +309,8 @@ class Api:
       # TODO: this functionality should be in the unimplemented streams base class
       # convert the stream instance info to stream data (serialize its current configuration)
       st_type = type(stream_inst).__name__.lower()
-      stream = models.Stream(id=sid, name=stream_inst.name, type=st_type)
+      # the stream instance was validated when it was configured, skip re-validating it on every refresh
+      stream = models.Stream.construct(id=sid, name=stream_inst.name, type=st_type)
       for field in optional_fields:
         if field in stream_inst.__dict__:
           stream.__dict__[field] = stream_inst.__dict__[field]
@@ -307,8 +320,34 @@ class Api:
     # TODO: stream/source info should be updated in a background thread
     for src in self.status.sources:
       self._update_src_info(src)
+    self.groups_by_id = utils.index_by_id(self.status.groups)
+    self.streams_by_id = utils.index_by_id(self.status.streams)
+    self.presets_by_id = utils.index_by_id(self.status.presets)
+    self._state_refreshed = time.monotonic()
+    self._state_changed = False
+    return self.status
+
+  def get_state_cached(self, max_age: float = 1.0) -> models.Status:
+    """ get the system state, reusing the last refresh if nothing has changed and it is less than @max_age seconds old
+
+    Changes made through this api always cause a refresh, the age limit keeps the stream's song info up to date.
+    This allows a burst of status requests to share a single refresh.
+    """
+    if self._state_changed or time.monotonic() - self._state_refreshed > max_age:
+      return self.get_state()
     return self.status
 
+  @staticmethod
+  def find_item(items: List[utils.BT], index: Dict[int, int], item_id: int) -> Union[Tuple[int, utils.BT], Tuple[None, None]]:
+    """ Find an item by id in one of the status lists using its id->index map, ie. status.groups and groups_by_id
+
+    The map is only rebuilt when the state is refreshed, so its result is checked and the list is scanned if it is out of date.
+    """
+    i = index.get(item_id)
+    if i is not None and i < len(items) and items[i].id == item_id:
+      return i, items[i]
+    return utils.find(items, item_id)
+
   def get_items(self, tag: str) -> Optional[List[models.Base]]:
     """ Gets one of the lists of elements contained in status named by @t (or t's plural
 
@@ -349,9 +388,10 @@ class Api:
       src.info = stream_inst.info()
     elif src.input == 'local' and src.id is not None:
       # RCA, name mimics the steam's formatting
-      src.info = models.SourceInfo(img_url='static/imgs/rca_inputs.svg', name=f'{src.name} - rca', state='unknown')
+      # these are refreshed on every status request and are always valid, so skip validation
+      src.info = models.SourceInfo.construct(img_url='static/imgs/rca_inputs.svg', name=f'{src.name} - rca', state='unknown')
     else:
-      src.info = models.SourceInfo(img_url='static/imgs/disconnected.png', name='None', state='stopped')
+      src.info = models.SourceInfo.construct(img_url='static/imgs/disconnected.png', name='None', state='stopped')
 
   def set_source(self, sid: int, update: models.SourceUpdate, force_update: bool = False, internal: bool = False) -> ApiResponse:
     """Modifes the configuration of one of the 4 system sources
@@ -842,7 +882,18 @@ class Api:
     return ApiResponse.ok()
 
   def announce(self, announcement: models.Announcement) -> ApiResponse:
-    """ Create and play an announcement """
+    """ Create and play an announcement, waiting for it to finish """
+    sid = self.start_announcement(announcement)
+    if isinstance(sid, ApiResponse):
+      return sid
+    # wait for the announcement to be done and switch back to the previous state
+    # TODO: what is the longest announcement we should accept?
+    while not self.announcement_done(sid):
+      time.sleep(0.1)
+    return self.finish_announcement(sid)
+
+  def start_announcement(self, announcement: models.Announcement) -> Union[ApiResponse, int]:
+    """ Start playing an announcement, returning the id of its temporary stream. See announce """
     # create a temporary announcement stream using fileplayer
     resp0 = self.create_stream(models.Stream(type='fileplayer', name='Announcement', url=announcement.media), internal=True)
     if isinstance(resp0, ApiResponse):
@@ -868,16 +919,22 @@ class Api:
     resp3 = self.delete_preset(pa_preset.id)
     if resp3.code != ApiCode.OK:
       return resp3
-    # wait for the announcement to be done and switch back to the previous state
-    # TODO: what is the longest announcement we should accept?
-    stream_inst = self.streams[stream.id]
-    while True:
-      time.sleep(0.1)
-      if stream_inst.state in ['stopped', 'disconnected']:
-        break
+    return stream.id
+
+  def announcement_done(self, sid: int) -> bool:
+    """ Check if the announcement playing on stream @sid is done
+
+    Other changes can be made while an announcement plays, so its stream may have already been removed
+    """
+    stream = self.streams.get(sid)
+    return stream is None or stream.state in ['stopped', 'disconnected']
+
+  def finish_announcement(self, sid: int) -> ApiResponse:
+    """ Switch back to the state before the announcement playing on stream @sid and remove its stream. See announce """
     resp4 = self.load_preset(self._LAST_PRESET_ID, internal=True)
-    resp5 = self.delete_stream(stream.id, internal=True) # remember to delete the temporary stream
-    if resp5.code != ApiCode.OK:
-      return resp5
+    if sid in self.streams:
+      resp5 = self.delete_stream(sid, internal=True) # remember to delete the temporary stream
+      if resp5.code != ApiCode.OK:
+        return resp5
     self.mark_changes()
     return resp4
@@ -18,6 +18,8 @@
 """Runtimes to communicate with the AmpliPi hardware
 """
 
+import functools
+import itertools
 import math
 import io
 import os
@@ -64,18 +66,31 @@ _SRC_TYPES = {
   1 : 'Digital',
   0 : 'Analog',
 }
-_DEV_ADDRS = [0x08, 0x10, 0x18, 0x20, 0x28, 0x30, 0x38, 0x40, 0x48, 0x50, 0x58, 0x60, 0x68, 0x70, 0x78]
-
+_DEV_ADDRS = (0x08, 0x10, 0x18, 0x20, 0x28, 0x30, 0x38, 0x40, 0x48, 0x50, 0x58, 0x60, 0x68, 0x70, 0x78)
+_DEV_ADDRS_SET = frozenset(_DEV_ADDRS)
+# The firmware mutes/unmutes channels and switches audio power right after these writes, give it time before the next write
+# TODO: remove this gap if back to back writes (relying on clock stretching) are validated on hardware
+_SETTLE_REGS = frozenset((_REG_ADDRS['MUTE'], _REG_ADDRS['STANDBY']))
+_SETTLE_TIME = 0.001
+_WRITE_RETRIES = 3 # retries of a failed write before giving up
+# Lookup tables packing a preamp's zone configuration into its register values
+# MUTE: one bit per zone, keyed by the 6 zone mutes
+_MUTE_LUT = {mutes: sum(0x01 << z for z, mute in enumerate(mutes) if mute) for mutes in itertools.product((False, True), repeat=6)}
+# CH123_SRC/CH456_SRC: two bits per zone, keyed by the sources of 3 zones
+_SRC_LUT = {srcs: srcs[0] | (srcs[1] << 2) | (srcs[2] << 4) for srcs in itertools.product(range(4), repeat=3)}
+
+@functools.lru_cache(1)
 def is_amplipi():
   """ Check if the current hardware is an AmpliPi
 
     Checks if the system is a Raspberry Pi Compute Module 3 Plus
-    with the proper serial port and I2C bus
+    with the proper serial port and I2C bus.
+    The hardware can't change while running, so this is only checked once.
 
     Returns:
       True if current hardware is an AmpliPi, False otherwise
   """
-  is_amplipi = True
+  ok = True
 
   # Check for Raspberry Pi
   try:
@@ -85,29 +100,30 @@ def is_amplipi():
       current_model = m.read()
       if desired_model.lower() not in current_model.lower():
         print(f"Device model '{current_model}'' doesn't match '{desired_model}*'")
-        is_amplipi = False
+        ok = False
   except Exception:
     print(f'Not running on a Raspberry Pi')
-    is_amplipi = False
+    ok = False
 
   # Check for the serial port
   if not os.path.exists('/dev/serial0'):
     print('Serial port /dev/serial0 not found')
-    is_amplipi = False
+    ok = False
 
   # Check for the i2c bus
   if not os.path.exists('/dev/i2c-1'):
     print('I2C bus /dev/i2c-1 not found')
-    is_amplipi = False
+    ok = False
 
-  return is_amplipi
+  return ok
 
 
 class _Preamps:
   """ Low level discovery and communication for the AmpliPi firmware
   """
 
-  preamps: Dict[int, List[int]] # Key: i2c address, Val: register values
+  preamps: Dict[int, bytearray] # Key: i2c address, Val: register values
+  _backoff: float = 0.0 # delay before retrying a failed write, doubled while writes keep failing
 
   def __init__(self, reset: bool = True, set_addr: bool = True, bootloader: bool = False):
     self.preamps = dict()
@@ -167,7 +183,8 @@ class _Preamps:
     """
     # Setup serial connection via UART pins
     with Serial('/dev/serial0', baudrate=9600) as ser:
-      ser.write((0x41, 0x10, 0x0D, 0x0A))
+      ser.write(b'\x41\x10\x0D\x0A')
+      ser.flush() # wait for the address to be sent so the delay below starts after it
 
     # Delay to account for addresses being set
     # Each box theoretically takes ~5ms to receive its address. Again, estimate for six boxes and include some padding
@@ -187,7 +204,7 @@ class _Preamps:
 
   def new_preamp(self, addr: int):
     """ Populate initial register values """
-    self.preamps[addr] = [
+    self.preamps[addr] = bytearray((
                             0x0F,
                             0x00,
                             0x00,
@@ -199,32 +216,60 @@ class _Preamps:
                             0x4F,
                             0x4F,
                             0x4F,
-                          ]
+                          ))
 
   def write_byte_data(self, preamp_addr, reg, data):
-    assert preamp_addr in _DEV_ADDRS
-    assert type(preamp_addr) == int
-    assert type(reg) == int
-    assert type(data) == int
-    # dynamically update preamps (to support mock)
-    if preamp_addr not in self.preamps:
-      if self.bus is None:
-        self.new_preamp(preamp_addr)
-      else:
-        return None # Preamp is not connected, do nothing
-
-    if DEBUG_PREAMPS:
-      print("writing to 0x{:02x} @ 0x{:02x} with 0x{:02x}".format(preamp_addr, reg, data))
-    self.preamps[preamp_addr][reg] = data
+    self.write_many([(preamp_addr, reg, data)])
+
+  def write_block_data(self, preamp_addr: int, start_reg: int, values: List[int]):
+    """ Write consecutive registers, starting at @start_reg """
+    self.write_many([(preamp_addr, start_reg + i, data) for i, data in enumerate(values)])
+
+  def write_many(self, writes: List[Tuple[int, int, int]]):
+    """ Write several registers, given as (preamp_addr, reg, data), in order
+
+    The firmware handles a single register per I2C message and doesn't auto-increment the register address,
+    so each register is sent as its own message. Messages are sent back to back, except after the
+    registers in _SETTLE_REGS. A failed write is retried with an increasing delay, resending from that write,
+    and the error is raised if it still fails after _WRITE_RETRIES retries.
+    """
+    pending = []
+    for preamp_addr, reg, data in writes:
+      assert type(preamp_addr) == int and type(reg) == int and type(data) == int and preamp_addr in _DEV_ADDRS_SET
+      assert 0 <= data <= 0xFF # registers are a single byte
+      # dynamically update preamps (to support mock)
+      if preamp_addr not in self.preamps:
+        if self.bus is None:
+          self.new_preamp(preamp_addr)
+        else:
+          continue # Preamp is not connected, skip it
+
+      if DEBUG_PREAMPS:
+        print("writing to 0x{:02x} @ 0x{:02x} with 0x{:02x}".format(preamp_addr, reg, data))
+      self.preamps[preamp_addr][reg] = data
+      pending.append((preamp_addr, reg, data))
     # TODO: need to handle volume modifying mute state in mock
-    if self.bus is not None:
+    if self.bus is None:
+      return
+    i = 0
+    failures = 0
+    while i < len(pending):
+      preamp_addr, reg, data = pending[i]
       try:
-        time.sleep(0.001) # space out sequential calls to avoid bus errors
         self.bus.write_byte_data(preamp_addr, reg, data)
       except Exception:
-        time.sleep(0.001)
+        failures += 1
+        if failures > _WRITE_RETRIES:
+          raise
+        # only pay for spacing out writes when the bus is having errors
+        self._backoff = min(max(self._backoff * 2, 0.001), 0.032)
+        time.sleep(self._backoff)
         self.bus = SMBus(1)
-        self.bus.write_byte_data(preamp_addr, reg, data)
+        continue # the writes before this one were acknowledged, so only resend from here
+      self._backoff = 0.0
+      i += 1
+      if reg in _SETTLE_REGS and i < len(pending):
+        time.sleep(_SETTLE_TIME)
 
   def probe_preamp(self, addr: int):
     # Scan for preamps, and set source registers to be completely digital
@@ -241,11 +286,13 @@ class _Preamps:
   def print_regs(self):
     """ Read all registers of every preamp and print """
     if self.bus is not None:
+      lines = []
       for preamp in self.preamps:
-        print(f'Preamp {preamp // 8}:')
+        lines.append(f'Preamp {preamp // 8}:')
         for reg, addr in _REG_ADDRS.items():
           val = self.bus.read_byte_data(preamp, addr)
-          print(f'  0x{addr:02X}:{reg:<15} = 0x{val:02X}')
+          lines.append(f'  0x{addr:02X}:{reg:<15} = 0x{val:02X}')
+      print('\n'.join(lines))
 
   def read_version(self, preamp: int = 1):
     """ Read the version of the first preamp if present
@@ -258,6 +305,8 @@ class _Preamps:
     """
     assert 1 <= preamp <= 6
     if self.bus is not None:
+      # The version registers are contiguous, but the preamp firmware only services a single register
+      # per I2C transaction (there is no register auto-increment), so they can't be read as one block
       major = self.bus.read_byte_data(preamp*8, _REG_ADDRS['VERSION_MAJOR'])
       minor = self.bus.read_byte_data(preamp*8, _REG_ADDRS['VERSION_MINOR'])
       git_hash = self.bus.read_byte_data(preamp*8, _REG_ADDRS['GIT_HASH_27_20']) << 20
@@ -393,10 +442,10 @@ class _Preamps:
       red = (led >> 1) & 0x01
       zones = [(led >> i) & 0x01 for i in range(2,8)]
       rg = 'YELLOW' if red and green else 'RED' if red else 'GREEN'
-      print('LEDS:        |         ZONES')
-      print('  ON/STANDBY | 1 | 2 | 3 | 4 | 5 | 6')
-      print('------------------------------------')
-      print(f'  {rg:^10} | {zones[0]} | {zones[1]} | {zones[2]} | {zones[3]} | {zones[4]} | {zones[5]}')
+      print('LEDS:        |         ZONES\n'
+            '  ON/STANDBY | 1 | 2 | 3 | 4 | 5 | 6\n'
+            '------------------------------------\n'
+            f'  {rg:^10} | {zones[0]} | {zones[1]} | {zones[2]} | {zones[3]} | {zones[4]} | {zones[5]}')
 
   def led_override(self, preamp: int = 1, leds: int = 0xFF):
     """ Override the LED board's LEDs
@@ -414,32 +463,35 @@ class _Preamps:
       self.bus.write_byte_data(preamp*8, _REG_ADDRS['LED_OVERRIDE'], leds)
 
   def print(self):
+    if not self.preamps:
+      return
+    lines = []
+    src_types = self.preamps[0x08][_REG_ADDRS['SRC_AD']]
+    src_cfg = ', '.join(_SRC_TYPES[(src_types >> src) & 0b01] for src in range(4))
     for preamp_addr in self.preamps.keys():
-      preamp = int(preamp_addr / 8)
-      print('preamp {}:'.format(preamp))
-      src_types = self.preamps[0x08][_REG_ADDRS['SRC_AD']]
-      src_cfg = []
-      for src in range(4):
-        src_type = _SRC_TYPES.get((src_types >> src) & 0b01)
-        src_cfg += ['{}'.format(src_type)]
-      print('  [{}]'.format(', '.join(src_cfg)))
+      preamp = preamp_addr // 8
+      lines.append(f'preamp {preamp}:')
+      lines.append(f'  [{src_cfg}]')
       for zone in range(6):
-        self.print_zone_state(6 * (preamp - 1) + zone)
+        lines.append(self.zone_state_str(6 * (preamp - 1) + zone))
+    print('\n'.join(lines))
 
   def print_zone_state(self, zone):
+    print(self.zone_state_str(zone))
+
+  def zone_state_str(self, zone) -> str:
+    """ Describe a zone's state from the mirrored preamp registers """
     assert zone >= 0
-    preamp = (int(zone / 6) + 1) * 8
-    zone = zone % 6
-    regs = self.preamps[preamp]
+    preamp, chan = divmod(zone, 6)
+    regs = self.preamps[_DEV_ADDRS[preamp]]
     src_types = self.preamps[0x08][_REG_ADDRS['SRC_AD']]
-    src = ((regs[_REG_ADDRS['CH456_SRC']] << 8) | regs[_REG_ADDRS['CH123_SRC']] >> 2 * zone) & 0b11
-    src_type = _SRC_TYPES.get((src_types >> src) & 0b01)
-    vol = -regs[_REG_ADDRS['CH1_ATTEN'] + zone]
-    muted = (regs[_REG_ADDRS['MUTE']] & (1 << zone)) > 0
-    state = []
-    if muted:
-      state += ['muted']
-    print('  {}({}) --> zone {} vol [{}] {}'.format(src, src_type[0], zone, extras.vol_string(vol), ', '.join(state)))
+    # each zone's source uses two bits, CH123_SRC holds zones 1-3 and CH456_SRC holds zones 4-6
+    src = (((regs[_REG_ADDRS['CH456_SRC']] << 6) | regs[_REG_ADDRS['CH123_SRC']]) >> 2 * chan) & 0b11
+    src_type = _SRC_TYPES[(src_types >> src) & 0b01]
+    vol = -regs[_REG_ADDRS['CH1_ATTEN'] + chan]
+    muted = (regs[_REG_ADDRS['MUTE']] & (1 << chan)) > 0
+    state = 'muted' if muted else ''
+    return f'  {src}({src_type[0]}) --> zone {chan} vol [{extras.vol_string(vol)}] {state}'
 
 class Mock:
   """ Mock of an Amplipi Runtime
@@ -461,8 +513,7 @@ class Mock:
         True on success, False on hw failure
     """
     assert len(digital) == 4
-    for flag in digital:
-      assert isinstance(flag, bool)
+    assert all(isinstance(flag, bool) for flag in digital)
     return True
 
   def update_zone_mutes(self, zone, mutes):
@@ -476,11 +527,9 @@ class Mock:
         True on success, False on hw failure
     """
     assert len(mutes) >= 6
-    num_preamps = int(len(mutes) / 6)
+    num_preamps = len(mutes) // 6
     assert len(mutes) == num_preamps * 6
-    for preamp in range(num_preamps):
-      for zid in range(6):
-        assert isinstance(mutes[preamp * 6 + zid], bool)
+    assert all(isinstance(mute, bool) for mute in mutes)
     return True
 
   def update_zone_sources(self, zone, sources):
@@ -494,12 +543,9 @@ class Mock:
         True on success, False on hw failure
     """
     assert len(sources) >= 6
-    num_preamps = int(len(sources) / 6)
+    num_preamps = len(sources) // 6
     assert len(sources) == num_preamps * 6
-    for preamp in range(num_preamps):
-      for zid in range(6):
-        src = sources[preamp * 6 + zid]
-        assert isinstance(src, int) or src is None
+    assert all(isinstance(src, int) or src is None for src in sources)
     return True
 
   def update_zone_vol(self, zone, vol):
@@ -542,29 +588,26 @@ class Rpi:
         True on success, False on hw failure
     """
     assert len(mutes) >= 6
-    num_preamps = int(len(mutes) / 6)
+    num_preamps = len(mutes) // 6
     assert len(mutes) == num_preamps * 6
     preamp = zone // 6
-    mute_cfg = 0x00
-    for z in range(6):
-      assert type(mutes[preamp * 6 + z]) == bool
-      if mutes[preamp * 6 + z]:
-        mute_cfg = mute_cfg | (0x01 << z)
-    self._bus.write_byte_data(_DEV_ADDRS[preamp], _REG_ADDRS['MUTE'], mute_cfg)
+    offset = preamp * 6
+    preamp_mutes = tuple(mutes[offset:offset + 6])
+    assert all(type(mute) == bool for mute in preamp_mutes)
+    mute_cfg = _MUTE_LUT[preamp_mutes]
+    writes = [(_DEV_ADDRS[preamp], _REG_ADDRS['MUTE'], mute_cfg)]
 
     # Audio power needs to be on each box when subsequent boxes are playing audio
+    # any standby change is sent to all preamps right after the mute change
     all_muted = False not in mutes
-    if self._all_muted != all_muted:
-      if all_muted:
-        for p in self._bus.preamps.keys():
-          # Standby all preamps
-          self._bus.write_byte_data(p, _REG_ADDRS['STANDBY'], 0x00)
-        time.sleep(0.1)
-      else:
-        for p in self._bus.preamps.keys():
-          # Unstandby all preamps
-          self._bus.write_byte_data(p, _REG_ADDRS['STANDBY'], 0x3F)
-        time.sleep(0.3)
+    standby_changed = self._all_muted != all_muted
+    if standby_changed:
+      standby = 0x00 if all_muted else 0x3F # Standby/Unstandby all preamps
+      writes += [(p, _REG_ADDRS['STANDBY'], standby) for p in self._bus.preamps]
+    self._bus.write_many(writes)
+
+    if standby_changed:
+      time.sleep(0.1 if all_muted else 0.3)
       self._all_muted = all_muted
     return True
 
@@ -579,21 +622,17 @@ class Rpi:
         True on success, False on hw failure
     """
     assert len(sources) >= 6
-    num_preamps = int(len(sources) / 6)
+    num_preamps = len(sources) // 6
     assert len(sources) == num_preamps * 6
     preamp = zone // 6
 
-    source_cfg123 = 0x00
-    source_cfg456 = 0x00
-    for z in range(6):
-      src = sources[preamp * 6 + z]
-      assert type(src) == int or src == None
-      if z < 3:
-        source_cfg123 = source_cfg123 | (src << (z*2))
-      else:
-        source_cfg456 = source_cfg456 | (src << ((z-3)*2))
-    self._bus.write_byte_data(_DEV_ADDRS[preamp], _REG_ADDRS['CH123_SRC'], source_cfg123)
-    self._bus.write_byte_data(_DEV_ADDRS[preamp], _REG_ADDRS['CH456_SRC'], source_cfg456)
+    offset = preamp * 6
+    preamp_sources = sources[offset:offset + 6]
+    assert all(type(src) == int or src == None for src in preamp_sources)
+    source_cfg123 = _SRC_LUT[tuple(preamp_sources[:3])]
+    source_cfg456 = _SRC_LUT[tuple(preamp_sources[3:])]
+    # CH123_SRC and CH456_SRC are consecutive
+    self._bus.write_block_data(_DEV_ADDRS[preamp], _REG_ADDRS['CH123_SRC'], [source_cfg123, source_cfg456])
 
     # TODO: Add error checking on successful write
     return True
@@ -608,12 +647,11 @@ class Rpi:
       Returns:
         True on success, False on hw failure
     """
-    preamp = int(zone / 6) # int(x/y) does the same thing as (x // y)
+    preamp, chan = divmod(zone, 6)
     assert zone >= 0
     assert preamp < 15
     assert vol <= 0 and vol >= -79
 
-    chan = zone - (preamp * 6)
     hvol = abs(vol)
 
     chan_reg = _REG_ADDRS['CH1_ATTEN'] + chan
@@ -638,8 +676,7 @@ class Rpi:
 
     # When digital is true, set the appropriate bit to 1
     assert len(digital) == 4
-    for d in digital:
-      assert type(d) == bool
+    assert all(type(d) == bool for d in digital)
 
     for i in range(4):
       if digital[i]:
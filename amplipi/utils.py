@@ -19,13 +19,13 @@
 This module contains helper functions are used across the amplipi python library.
 """
 
-import json
 import os
 import functools
 import subprocess
 import re
 from typing import List, Dict, Set, Union, Optional, Tuple, TypeVar, Iterable
 
+import orjson
 import pkg_resources # version
 
 import amplipi.models as models
@@ -35,11 +35,12 @@ import amplipi.models as models
 # Helper functions
 def encode(pydata):
   """ Encode a dictionary as JSON """
-  return json.dumps(pydata)
+  # like json.dumps, allow non-string keys (ie. ids)
+  return orjson.dumps(pydata, option=orjson.OPT_NON_STR_KEYS).decode()
 
 def decode(j):
   """ Decode JSON into dictionary """
-  return json.loads(j)
+  return orjson.loads(j)
 
 def parse_int(i, options):
   """ Parse an integer into one of the given options """
@@ -64,24 +65,15 @@ BT = TypeVar("BT", bound='models.Base', covariant=True)
 
 def find(items: Iterable[BT], item_id: int, key='id') -> Union[Tuple[int, BT], Tuple[None, None]]:
   """ Find an item by id """
-  for i, item in enumerate(items):
-    if item.__dict__[key] == item_id:
-      return i, item
-  return None, None
+  return next(((i, item) for i, item in enumerate(items) if getattr(item, key) == item_id), (None, None))
+
+def index_by_id(items: Iterable[BT]) -> Dict[int, int]:
+  """ Map each item's id to its index """
+  return {item.id: i for i, item in enumerate(items) if item.id is not None}
 
 def next_available_id(items: Iterable[BT], default: int = 0) -> int:
   """ Get a new unique id among @items """
-  # TODO; use `largest_item = max(items, key=lambda item: item.id, default=None)` to find max if models.Base changes id to be required
-  largest_id = None
-  for item in items:
-    if item.id is not None:
-      if largest_id is not None:
-        largest_id = max(largest_id, item.id)
-      else:
-        largest_id = item.id
-  if largest_id is not None:
-    return largest_id + 1
-  return default
+  return max((item.id for item in items if item.id is not None), default=default - 1) + 1
 
 def clamp(xval, xmin, xmax):
   """ Clamp and value between min and max """
@@ -112,7 +104,11 @@ def abbreviate_src(src_type):
 
 def src_zones(status: models.Status) -> Dict[int, List[int]]:
   """ Get a mapping from source ids to zones """
-  return { src.id : [ zone.id for zone in status.zones if zone.id is not None and zone.source_id == src.id] for src in status.sources if src.id is not None}
+  mapping: Dict[int, List[int]] = {src.id: [] for src in status.sources if src.id is not None}
+  for zone in status.zones:
+    if zone.id is not None and zone.source_id in mapping:
+      mapping[zone.source_id].append(zone.id)
+  return mapping
 
 @functools.lru_cache(1)
 def available_outputs():
@@ -123,10 +119,14 @@ def available_outputs():
 
   This will cache the result since alsa outputs do not change dynamically (unless you edit a config file).
   """
+  outputs = []
   try:
-    outputs = [ o for o in subprocess.check_output('aplay -L'.split()).decode().split('\n') if o and o[0] != ' ' ]
-  except:
-    outputs = []
+    result = subprocess.run(['aplay', '-L'], capture_output=True, text=True, check=False)
+    outputs = [line for line in result.stdout.splitlines() if line and line[0] != ' ']
+  except FileNotFoundError:
+    pass # aplay is not installed, there are no alsa outputs to find
+  except Exception as exc:
+    print(f'Error listing alsa outputs: {exc}')
   if 'ch0' not in outputs:
     print('WARNING: ch0, ch1, ch2, ch3 audio devices not found. Is this running on an AmpliPi?')
   return outputs
@@ -183,11 +183,12 @@ def detect_version() -> str:
   script_folder = os.path.dirname(os.path.realpath(__file__))
   try:
     with open(os.path.join(script_folder, '..', 'pyproject.toml')) as proj_file:
-      for line in proj_file.readlines():
-        if 'version' in line:
+      for line in proj_file:
+        if line.startswith('version'): # the project version is the first top level version key
           match = TOML_VERSION_STR.search(line)
           if match is not None:
             version = match.group(1)
+            break
   except:
     pass
   if version == 'unknown':
@@ -1,6 +1,6 @@
 """ Test the amplipi rest API """
 
-from typing import List
+from typing import List, Dict
 
 # json utils
 import json
@@ -9,7 +9,9 @@ from http import HTTPStatus
 # temporary directory for each test config
 import tempfile
 import os
-from copy import deepcopy # copy test config
+
+# websocket reads are bounded by reading on another thread
+import threading
 
 import pytest
 from fastapi.testclient import TestClient
@@ -24,9 +26,13 @@ def base_config():
   """ Default Amplipi configuration """
   return amplipi.ctrl.Api.DEFAULT_CONFIG
 
+def json_copy(data):
+  """ Copy json compatible @data, this is much faster than deepcopy """
+  return json.loads(json.dumps(data))
+
 def base_config_copy():
   """ Modify-able Amplipi configuration """
-  return deepcopy(base_config())
+  return json_copy(base_config())
 
 def base_config_no_presets():
   """ AmpliPi configuration with presets field unpopulated """
@@ -54,17 +60,22 @@ def find(elements:List, eid:int):
       return i
   return None
 
+def index_by_id(elements:List) -> Dict:
+  """ Index elements by id, use this instead of find for repeated lookups """
+  return {i['id']: i for i in elements}
+
 @pytest.fixture(params=[base_config_copy(), base_config_no_presets(), base_config_no_groups()])
 def client(request):
   """ AmpliPi instance with mocked ctrl and streams """
   cfg = request.param
   config_dir = tempfile.mkdtemp()
   config_file = os.path.join(config_dir, 'house.json')
+  cfg_json = json.dumps(cfg)
   with open(config_file, 'w') as cfg_file:
-    cfg_file.write(json.dumps(cfg))
+    cfg_file.write(cfg_json)
   app = amplipi.app.create_app(mock_ctrl=True, mock_streams=True, config_file=config_file, delay_saves=False)
   c = TestClient(app)
-  c.original_config = deepcopy(cfg) # add the loaded config so we can remember what was loaded
+  c.original_config = json.loads(cfg_json) # add the loaded config so we can remember what was loaded
   return c
 
 @pytest.fixture(params=[base_config_copy(), base_config_no_presets(), base_config_no_groups()])
@@ -73,11 +84,12 @@ def clientnm(request):# Non-mock systems should use this client - mock_ctrl and
   cfg = request.param
   config_dir = tempfile.mkdtemp()
   config_file = os.path.join(config_dir, 'house.json')
+  cfg_json = json.dumps(cfg)
   with open(config_file, 'w') as cfg_file:
-    cfg_file.write(json.dumps(cfg))
+    cfg_file.write(cfg_json)
   app = amplipi.app.create_app(mock_ctrl=False, mock_streams=False, config_file=config_file, delay_saves=False)
   c = TestClient(app)
-  c.original_config = deepcopy(cfg) # add the loaded config so we can remember what was loaded
+  c.original_config = json.loads(cfg_json) # add the loaded config so we can remember what was loaded
   return c
 
 # TODO: the web view test should be added to its own testfile once we add more functionality to the site
@@ -106,6 +118,31 @@ def test_view_changes(client: TestClient):
   assert rv.status_code == HTTPStatus.OK
   assert 'patched-name' in rv.text, 'zone name was not updated on the webapp'
 
+def receive_json(ws, timeout: float = 5.0):
+  """ Receive json from websocket @ws, failing instead of hanging if nothing is received within @timeout seconds """
+  received = []
+  reader = threading.Thread(target=lambda: received.append(ws.receive_json()), daemon=True)
+  reader.start()
+  reader.join(timeout)
+  assert received, f'nothing received within {timeout}s'
+  return received[0]
+
+def test_state_push(client: TestClient):
+  """ Check that the state is pushed over a websocket on connection and after a change """
+  with client.websocket_connect('/ws/state') as ws:
+    jrv = receive_json(ws)
+    z = find(jrv['zones'], 0)
+    assert z is not None
+    assert z['name'] != 'patched-name'
+    rv = client.patch('/api/zones/0', json={'name': 'patched-name'})
+    assert rv.status_code == HTTPStatus.OK
+    # unrelated changes (ie. song info) may be pushed first
+    for _ in range(3):
+      jrv = receive_json(ws)
+      if find(jrv['zones'], 0)['name'] == 'patched-name':
+        break
+    assert find(jrv['zones'], 0)['name'] == 'patched-name'
+
 @pytest.mark.parametrize('path', ['/api', '/api/'])
 def test_base(client, path):
     """ Start with a basic controller and just check if it gives a real response """
@@ -125,6 +162,21 @@ def test_base(client, path):
       assert path == '/api'
       assert '/api/' in rv.location
 
+def test_base_compressed(client):
+  """ Check that the status is compressed for clients that support it """
+  rv = client.get('/api', headers={'Accept-Encoding': 'gzip'})
+  assert rv.status_code == HTTPStatus.OK
+  assert rv.headers.get('content-encoding') == 'gzip'
+  assert 'zones' in rv.json() # the test client transparently decompresses
+
+@pytest.mark.parametrize('path', ['/static/imgs/amplipi_banner_black.png', '/api/sources/0/image/200'])
+def test_image_not_compressed(client, path):
+  """ Check that images, which are already compressed, are sent as is """
+  rv = client.get(path, headers={'Accept-Encoding': 'gzip'})
+  assert rv.status_code == HTTPStatus.OK
+  assert 'content-encoding' not in rv.headers
+  assert int(rv.headers['content-length']) == len(rv.content)
+
 def test_open_api_yamlfile(client):
     """ Check if the openapi yaml doc is available """
     rv = client.get('/openapi.yaml')
@@ -261,11 +313,28 @@ def test_delete_group(client, gid):
     assert rv.status_code != HTTPStatus.OK
     return
   jrv = rv.json()
-  s = find(jrv['groups'], gid)
-  assert s is None
+  remaining = index_by_id(jrv['groups'])
+  assert gid not in remaining
   for other_gid in base_group_ids():
     if other_gid != gid:
-      assert find(jrv['groups'], other_gid) is not None
+      assert other_gid in remaining
+
+@pytest.mark.parametrize('gid', base_group_ids())
+def test_get_group_after_delete(client, gid):
+  """ Check that the remaining groups are still found after deleting a group in front of them """
+  gids = [g['id'] for g in client.original_config.get('groups', [])]
+  if gid not in gids:
+    return
+  for other_gid in gids:
+    assert client.get('/api/groups/{}'.format(other_gid)).status_code == HTTPStatus.OK
+  rv = client.delete('/api/groups/{}'.format(gid))
+  assert rv.status_code == HTTPStatus.OK
+  assert client.get('/api/groups/{}'.format(gid)).status_code == HTTPStatus.NOT_FOUND
+  for other_gid in gids:
+    if other_gid != gid:
+      rv = client.get('/api/groups/{}'.format(other_gid))
+      assert rv.status_code == HTTPStatus.OK
+      assert rv.json()['id'] == other_gid
 
 # test streams
 def base_stream_ids():
@@ -309,6 +378,17 @@ def test_patch_stream_rename(client, sid):
   assert s is not None
   assert s['name'] == 'patched-name'
 
+@pytest.mark.parametrize('sid', base_stream_ids())
+def test_get_stream_after_rename(client, sid):
+  """ Make sure a renamed stream is reported right away, even though the status is cached between requests """
+  rv = client.get('/api/streams/{}'.format(sid))
+  assert rv.status_code == HTTPStatus.OK
+  rv = client.patch('/api/streams/{}'.format(sid), json={'name': 'patched-name'})
+  assert rv.status_code == HTTPStatus.OK
+  rv = client.get('/api/streams/{}'.format(sid))
+  assert rv.status_code == HTTPStatus.OK
+  assert rv.json()['name'] == 'patched-name'
+
 # /streams/{streamId} delete-stream
 @pytest.mark.parametrize('sid', base_stream_ids())
 def test_delete_stream(client, sid):
@@ -318,12 +398,12 @@ def test_delete_stream(client, sid):
   jrv = rv.json() # get the system state returned
   # TODO: check that the system state is valid
   # make sure the stream was deleted
-  s = find(jrv['streams'], sid)
-  assert s is None
+  remaining = index_by_id(jrv['streams'])
+  assert sid not in remaining
   # make sure the rest of the streams are still there
   for other_sid in base_stream_ids():
     if other_sid != sid:
-      assert find(jrv['streams'], other_sid) is not None
+      assert other_sid in remaining
 
 @pytest.mark.parametrize('sid', base_stream_ids())
 def test_delete_connected_stream(client, sid):
@@ -424,12 +504,12 @@ def test_delete_preset(client, pid):
   jrv = rv.json() # get the system state returned
   # TODO: check that the system state is valid
   # make sure the preset was deleted
-  s = find(jrv['presets'], pid)
-  assert s is None
+  remaining = index_by_id(jrv['presets'])
+  assert pid not in remaining
   # make sure the rest of the presets are still there
   for other_pid in base_preset_ids():
     if other_pid != pid:
-      assert find(jrv['presets'], other_pid) is not None
+      assert other_pid in remaining
 
 # /presets/{presetId}/load load-preset
 @pytest.mark.parametrize('pid', base_preset_ids())
@@ -445,12 +525,13 @@ def test_load_preset(client, pid, unmuted=[1,2,3]):
   # load the preset (in some configurations it won't exist; make sure it fails in that case)
   rv = client.post('/api/presets/{}/load'.format(pid))
   p = find(last_state['presets'], pid)
+  last_groups = index_by_id(last_state['groups'])
   if p:
     # check if all of the needed groups exist (it will fail if one of the needed groups doesn't exist')
     effected_groups = { g['id'] for g in p['state'].get('groups', [])}
     missing = False
     for g in effected_groups:
-      if not find(last_state['groups'], g):
+      if g not in last_groups:
         missing = True
     if missing:
       assert rv.status_code != HTTPStatus.OK
@@ -464,19 +545,20 @@ def test_load_preset(client, pid, unmuted=[1,2,3]):
   # TODO: check that the system state is valid
   # make sure the rest of the config got loaded
   for mod, configs in p['state'].items():
+    updated_cfgs = index_by_id(jrv[mod])
     for cfg in configs:
       # each of the keys in the configuration should match
-      updated_cfg = find(jrv[mod], cfg['id'])
+      updated_cfg = updated_cfgs.get(cfg['id'])
       assert updated_cfg is not None
       for k, v in cfg.items():
         assert updated_cfg[k] == v
   # verify all of the zones mute levels remained the same (unless they were changed by the preset configuration)
-  preset_zones_changes = p['state'].get('zones', None)
+  preset_zones_changes = index_by_id(p['state'].get('zones', []))
   preset_groups_changes = p['state'].get('groups', None)
   for z in jrv['zones']:
     expected_mute = last_state['zones'][z['id']]['mute']
     if preset_zones_changes:
-      pz = find(preset_zones_changes, z['id'])
+      pz = preset_zones_changes.get(z['id'])
       if pz and 'mute' in pz:
         expected_mute = pz['mute']
     # check if the zone will be muted by a group (group updates are currently applied after zone updates)
@@ -485,7 +567,7 @@ def test_load_preset(client, pid, unmuted=[1,2,3]):
     if preset_groups_changes:
       for pg in preset_groups_changes:
         if 'mute' in pg:
-          g = find(last_state['groups'], pg['id'])
+          g = last_groups.get(pg['id'])
           assert g is not None
           if z['id'] in g['zones']:
             expected_mute = pg['mute']
@@ -498,10 +580,10 @@ def test_load_preset(client, pid, unmuted=[1,2,3]):
   jrv.pop('info')
   ignore = ['last_used', 'info', 'status']
   for name, mod in jrv.items():
-    prev_mod = last_state[name]
+    prev_mod = index_by_id(last_state[name])
     for cfg in mod:
       if cfg['id'] != LAST_CONFIG_PRESET:
-        prev_cfg = find(prev_mod, cfg['id'])
+        prev_cfg = prev_mod.get(cfg['id'])
         for ignored_field in ignore:
           if ignored_field in prev_cfg:
             prev_cfg.pop(ignored_field)
@@ -540,6 +622,20 @@ def test_api_doc_has_examples(client):
       except KeyError:
         pass # reposnse could not be json
 
+def test_api_doc_examples_follow_config(client):
+  """ Make sure the live parameter examples are regenerated when the configuration changes """
+  sid = base_stream_ids()[0]
+  rv = client.get('/openapi.json')
+  assert rv.status_code == HTTPStatus.OK
+  rv = client.patch('/api/streams/{}'.format(sid), json={'name': 'patched-name'})
+  assert rv.status_code == HTTPStatus.OK
+  rv = client.get('/openapi.json')
+  assert rv.status_code == HTTPStatus.OK
+  params = rv.json()['paths']['/api/streams/{sid}']['get']['parameters']
+  examples = next(param['examples'] for param in params if param['name'] == 'sid')
+  assert 'patched-name' in examples
+  assert examples['patched-name']['value'] == sid
+
 # TODO: this test will fail until we come up with a good scheme for specifying folder locations in a global config
 # The test below fails since the test and the app are run in different directories
 # skipping it for now until #117
@@ -58,6 +58,26 @@ function refresh() {
   get();
 }
 
+// the server pushes the system state whenever it changes, poll for it instead while that isn't available
+var poller = null;
+function subscribe() {
+  const proto = window.location.protocol == 'https:' ? 'wss:' : 'ws:';
+  let ws = new WebSocket(proto + '//' + window.location.host + '/ws/state');
+  ws.onopen = function() {
+    clearInterval(poller);
+    poller = null;
+  };
+  ws.onmessage = function(msg) {
+    onResponse(JSON.parse(msg.data));
+  };
+  ws.onclose = function() {
+    if (poller === null) {
+      poller = setInterval(refresh, 2000);
+    }
+    setTimeout(subscribe, 10000); // try to reconnect
+  };
+}
+
 $(document).ready(function(){
   // Some things are not part of the automatic tab-content switching
   // hide things related to the old src and show things related to the new one
@@ -81,7 +101,7 @@ $(document).ready(function(){
       updateSettings();
     }
   });
-  setInterval(refresh, 2000);
+  subscribe();
 });
 
 function updateVol(ctrl, muted, vol) {